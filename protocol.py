@@ -1,26 +1,65 @@
 import asyncio
+import hashlib
+import logging
 import re, os
 import traceback
+from dataclasses import asdict, dataclass
 from datetime import datetime, timezone
-from typing import Dict, Any, List
-from uuid import uuid4
-from openai import OpenAI
+from operator import attrgetter
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple
+from uuid import UUID, uuid4
+from weakref import WeakValueDictionary
+import openai
+import orjson
+import redis.asyncio
+from cachetools import TTLCache
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from uagents import Context, Protocol
 from uagents_core.contrib.protocols.chat import (
     ChatAcknowledgement,
     ChatMessage,
     EndSessionContent,
+    EndStreamContent,
     StartSessionContent,
+    StartStreamContent,
     TextContent,
     chat_protocol_spec,
 )
 
 # ASI1 API Configuration
 ASI1_API_KEY = os.getenv("ASI1_API_KEY")
-client = OpenAI(
+client = AsyncOpenAI(
     api_key=ASI1_API_KEY,
     base_url="https://api.asi1.ai/v1"
 )
+# Chat completions retry through tenacity only: SDK retries would sleep inside a
+# concurrency slot and multiply the attempts
+llm_client = client.with_options(max_retries=0)
+
+# Cap on in-flight ASI1 requests so bursts queue here instead of tripping rate limits
+ASI1_MAX_CONCURRENCY = int(os.getenv("ASI1_MAX_CONCURRENCY", "8"))
+llm_semaphore = asyncio.Semaphore(ASI1_MAX_CONCURRENCY)
+
+# Optional Redis session store (falls back to agent storage when unset)
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.asyncio.from_url(REDIS_URL) if REDIS_URL else None
+SESSION_TTL_SECONDS = 24 * 60 * 60
+HISTORY_WINDOW = 20  # most recent messages loaded per turn (prompts use at most this many)
+MAX_STORED_CHARS = 8000  # cap per history message; a 2000-token reply stays well under it
+PROMPT_MESSAGE_CHARS = 1500  # per-message cap when replaying history into a prompt
+STREAM_CHUNK_CHARS = 500  # streamed replies are sent in pieces of roughly this size, split at line breaks
+RESPONSE_CACHE_TTL_SECONDS = 60 * 60
+
+# Rolling summary: once more than SUMMARY_TRIGGER messages are unsummarized, older ones
+# are folded into state["rolling_summary"] and only the last RECENT_MESSAGES stay verbatim
+SUMMARY_TRIGGER = 12
+RECENT_MESSAGES = 6
+
+# Recently active sessions are kept in-process in front of Redis / agent storage
+local_sessions = TTLCache(maxsize=10_000, ttl=300)
+# Per-session locks; an entry lives only while a handler or save task holds a reference
+session_locks = WeakValueDictionary()
 
 # Initialize the chat protocol with the standard chat spec
 chat_proto = Protocol(spec=chat_protocol_spec)
@@ -28,73 +67,213 @@ chat_proto = Protocol(spec=chat_protocol_spec)
 
 # ============== Session Storage Functions ==============
 
+@dataclass(slots=True)
+class Turn:
+    role: str
+    content: str
+    timestamp: str
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Turn":
+        return cls(data["role"], data["content"], data.get("timestamp", ""))
+
+
 def get_session_key(sender: str, session_id: str) -> str:
     return f"session:{sender}:{session_id}"
 
 
-def get_session_data(ctx: Context, sender: str, session_id: str) -> Dict[str, Any]:
+def get_session_lock(name: str) -> asyncio.Lock:
+    lock = session_locks.get(name)
+    if lock is None:
+        lock = session_locks[name] = asyncio.Lock()
+    return lock
+
+
+async def get_session_data(ctx: Context, sender: str, session_id: str, timestamp: Optional[str] = None) -> Dict[str, Any]:
     key = get_session_key(sender, session_id)
-    if ctx.storage.has(key):
-        data = ctx.storage.get(key)
-        if isinstance(data, dict):
-            ctx.logger.info(f"Loaded session: {session_id}, {len(data.get('history', []))} messages")
-            return data
-
-    ctx.logger.info(f"Creating new session: {session_id}")
-    return {
+    cached = local_sessions.get(key)
+    if cached is not None:
+        return cached
+
+    # Saves still pending for this session (one may be waiting on the summary call) land
+    # before storage is read; each re-caches the session, so look in the cache again after
+    saves = [task for task in pending_saves if task.get_name() == key]
+    if saves:
+        await asyncio.wait(saves)
+        cached = local_sessions.get(key)
+        if cached is not None:
+            return cached
+
+    if redis_client is not None:
+        # State and history live under separate keys; only the recent history window is read,
+        # all in one pipelined round-trip
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(f"{key}:state")
+            pipe.lrange(f"{key}:history", -HISTORY_WINDOW, -1)
+            pipe.llen(f"{key}:history")
+            raw_state, raw_history, history_length = await pipe.execute()
+        data = None
+        if raw_state:
+            history = [Turn.from_dict(orjson.loads(item)) for item in raw_history]
+            data = {
+                "history": history,
+                "state": orjson.loads(raw_state),
+                "history_saved": len(history),
+                "history_offset": history_length - len(history)
+            }
+    else:
+        stored = ctx.storage.get(key) if ctx.storage.has(key) else None
+        data = None
+        if isinstance(stored, dict):
+            # A new dict: the stored one must stay JSON-serializable for agent storage
+            data = {"history": [Turn.from_dict(msg) for msg in stored.get("history", [])], "state": stored.get("state", {})}
+
+    if isinstance(data, dict):
+        ctx.logger.debug("Loaded session: %s, %d messages", session_id, len(data["history"]))
+        local_sessions[key] = data
+        return data
+
+    ctx.logger.debug("Creating new session: %s", session_id)
+    data = local_sessions[key] = {
         "history": [],
         "state": {
             "greeted": False,
-            "created_at": datetime.now(timezone.utc).isoformat(),
+            "created_at": timestamp or datetime.now(timezone.utc).isoformat(),
             "current_phase": "intake",
             "fitness_profile": {},
             "goals": [],
             "workout_plan": {},
             "meal_plan": {},
-            "progress_log": []
+            "progress_log": [],
+            "rolling_summary": "",
+            "summarized_up_to": 0
         }
     }
+    return data
 
 
-def save_session_data(ctx: Context, sender: str, session_id: str, session_data: Dict[str, Any]) -> None:
+async def save_session_data(ctx: Context, sender: str, session_id: str, session_data: Dict[str, Any], timestamp: Optional[str] = None) -> None:
     key = get_session_key(sender, session_id)
-    session_data["state"]["updated_at"] = datetime.now(timezone.utc).isoformat()
-    ctx.storage.set(key, session_data)
-    ctx.logger.info(f"Saved session: {session_id}, {len(session_data.get('history', []))} messages")
+    session_data["state"]["updated_at"] = timestamp or datetime.now(timezone.utc).isoformat()
+    local_sessions[key] = session_data
+    if redis_client is not None:
+        # Append only the messages added since the last save. The cached copy keeps just the
+        # recent window in memory; older messages are already in the Redis list
+        history = session_data["history"]
+        new_messages = history[session_data.get("history_saved", 0):]
+        overflow = len(history) - HISTORY_WINDOW
+        if overflow > 0:
+            del history[:overflow]
+            session_data["history_offset"] = session_data.get("history_offset", 0) + overflow
+        session_data["history_saved"] = len(history)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.setex(f"{key}:state", SESSION_TTL_SECONDS, orjson.dumps(session_data["state"]))
+            if new_messages:
+                pipe.rpush(f"{key}:history", *(orjson.dumps(msg) for msg in new_messages))
+            pipe.expire(f"{key}:history", SESSION_TTL_SECONDS)
+            await pipe.execute()
+    else:
+        # Agent storage is JSON-backed, so turns are stored as plain dicts
+        ctx.storage.set(key, {
+            "history": [asdict(turn) for turn in session_data["history"]],
+            "state": session_data["state"]
+        })
+    ctx.logger.debug("Saved session: %s, %d messages", session_id, len(session_data["history"]))
 
 
-def add_to_history(history: List[Dict], role: str, content: str) -> List[Dict]:
-    history.append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now(timezone.utc).isoformat()
-    })
-    return history
+# Background save tasks, held until done so they are not garbage-collected mid-write
+pending_saves = set()
+
+
+async def persist_session(ctx: Context, sender: str, session_id: str, session_data: Dict[str, Any], summarize: bool = False, timestamp: Optional[str] = None) -> None:
+    try:
+        # Saves of one session run one at a time, in the order they were scheduled
+        async with get_session_lock(f"{get_session_key(sender, session_id)}:save"):
+            if summarize:
+                await update_rolling_summary(session_data)
+            await save_session_data(ctx, sender, session_id, session_data, timestamp)
+    except Exception as e:
+        ctx.logger.error("Failed to save session %s: %s", session_id, e)
+
+
+def schedule_save(ctx: Context, sender: str, session_id: str, session_data: Dict[str, Any], summarize: bool = False, timestamp: Optional[str] = None) -> None:
+    # Persistence is off the reply path: the task runs while the response is being sent
+    task = asyncio.create_task(
+        persist_session(ctx, sender, session_id, session_data, summarize, timestamp),
+        name=get_session_key(sender, session_id)
+    )
+    pending_saves.add(task)
+    task.add_done_callback(pending_saves.discard)
+
+
+def add_to_history(history: List[Turn], role: str, content: str, timestamp: Optional[str] = None) -> None:
+    history.append(Turn(role, content[:MAX_STORED_CHARS], timestamp or datetime.now(timezone.utc).isoformat()))
 
 
-def build_context_summary(history: List[Dict], max_messages: int = 20) -> str:
+def get_recent_history(session_data: Dict[str, Any]) -> List[Turn]:
+    # Messages not yet folded into the rolling summary ("summarized_up_to" counts from the first message)
+    history = session_data["history"]
+    start = session_data["state"].get("summarized_up_to", 0) - session_data.get("history_offset", 0)
+    return history[max(start, len(history) - HISTORY_WINDOW, 0):]
+
+
+def build_context_summary(history: List[Turn], max_messages: int = 20, max_chars: int = 500) -> str:
     if not history:
         return ""
-    recent = history[-max_messages:] if len(history) > max_messages else history
     lines = []
-    for msg in recent:
-        role = "User" if msg["role"] == "user" else "Assistant"
-        content = msg['content'][:500] + "..." if len(msg['content']) > 500 else msg['content']
-        lines.append(f"{role}: {content}")
+    for msg in history[-max_messages:]:
+        role = "User" if msg.role == "user" else "Assistant"
+        if len(msg.content) > max_chars:
+            lines.append(f"{role}: {msg.content[:max_chars]}...")
+        else:
+            lines.append(f"{role}: {msg.content}")
     return "\n".join(lines)
 
 
-def extract_text(msg: ChatMessage) -> str:
+history_fields = attrgetter("role", "content")
+
+
+def build_history_messages(history: List[Turn]) -> List[Dict]:
+    # Slicing past the end is a no-op, so no length check is needed
+    return [
+        {"role": role, "content": content[:PROMPT_MESSAGE_CHARS]}
+        for role, content in map(history_fields, history)
+    ]
+
+
+def extract_content(msg: ChatMessage) -> Tuple[str, bool, bool]:
+    # Single pass over the content list: (first text, has start-session, has end-session)
+    text, start_session, end_session = "", False, False
     for item in msg.content:
         if isinstance(item, TextContent):
-            return item.text
-    return ""
+            text = text or item.text
+        elif isinstance(item, StartSessionContent):
+            start_session = True
+        elif isinstance(item, EndSessionContent):
+            end_session = True
+    return text, start_session, end_session
 
 
-def create_text_chat(text: str, end_session: bool = False) -> ChatMessage:
+def create_text_chat(text: str, end_session: bool = False, timestamp: Optional[datetime] = None) -> ChatMessage:
     content: list = [TextContent(type="text", text=text)]
     if end_session:
         content.append(EndSessionContent(type="end-session"))
+    return ChatMessage(
+        timestamp=timestamp or datetime.now(timezone.utc),
+        msg_id=uuid4(),
+        content=content,
+    )
+
+
+def create_stream_chat(stream_id: UUID, text: Optional[str] = None, start: bool = False) -> ChatMessage:
+    # One streamed chunk (opening the stream when start is set), or the end-of-stream marker without text
+    content = []
+    if start:
+        content.append(StartStreamContent(type="start-stream", stream_id=stream_id))
+    if text is not None:
+        content.append(TextContent(type="text", text=text))
+    else:
+        content.append(EndStreamContent(type="end-stream", stream_id=stream_id))
     return ChatMessage(
         timestamp=datetime.now(timezone.utc),
         msg_id=uuid4(),
@@ -102,6 +281,64 @@ def create_text_chat(text: str, end_session: bool = False) -> ChatMessage:
     )
 
 
+# ============== ASI1 Requests ==============
+
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type(openai.RateLimitError),
+    reraise=True,
+)
+async def create_chat_completion(**kwargs):
+    # The semaphore is taken per attempt, so backoff sleeps don't hold a slot
+    async with llm_semaphore:
+        return await llm_client.chat.completions.create(model="asi1", **kwargs)
+
+
+async def drain_chunks(chunks: asyncio.Queue, on_chunk: Callable[[str], Awaitable[None]]) -> None:
+    while (chunk := await chunks.get()) is not None:
+        await on_chunk(chunk)
+
+
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type(openai.RateLimitError),
+    reraise=True,
+)
+async def stream_chat_completion(on_chunk: Optional[Callable[[str], Awaitable[None]]], **kwargs) -> str:
+    # Streams the reply, handing on_chunk whole lines once STREAM_CHUNK_CHARS have built up,
+    # and returns the full text. Only reading the stream holds the slot: chunks are queued for
+    # a separate sender task, so slow or retried sends don't block other users' requests
+    chunks = asyncio.Queue()
+    sender = asyncio.create_task(drain_chunks(chunks, on_chunk)) if on_chunk is not None else None
+    try:
+        async with llm_semaphore:
+            stream = await llm_client.chat.completions.create(model="asi1", stream=True, **kwargs)
+            parts = []
+            pending = ""
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                parts.append(delta)
+                if sender is None:
+                    continue
+                pending += delta
+                if len(pending) >= STREAM_CHUNK_CHARS:
+                    cut = pending.rfind("\n") + 1 or len(pending)
+                    chunks.put_nowait(pending[:cut])
+                    pending = pending[cut:]
+        if pending:
+            chunks.put_nowait(pending)
+        return "".join(parts)
+    finally:
+        # Chunks already queued are still delivered before returning or raising
+        if sender is not None:
+            chunks.put_nowait(None)
+            await sender
+
+
 # ============== System Prompt (Planner Mode) ==============
 
 SYSTEM_PROMPT = """You are a certified Fitness Goal Planner powered by AI planning capabilities. You guide users through a structured, multi-phase fitness journey using ONLY your planning and reasoning abilities — no web search.
@@ -178,12 +415,96 @@ Set up a monitoring system:
 - Provide alternatives for exercises when equipment is limited
 - All advice is based on general fitness principles, not medical advice"""
 
+# Shared, never mutated: every request starts with the byte-identical system prompt so
+# ASI1 can reuse its cached prefix; per-session context goes in later messages
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+# ============== Canned Replies ==============
+
+# Sent when ASI1 gives no usable answer. A question repeated after one of these is a retry,
+# so it is planned again rather than answered from history
+FALLBACK_REPLIES = {
+    "no_context_answer": "I couldn't find the information in our conversation. Could you rephrase?",
+    "context_error": "An error occurred while reviewing our conversation. Please try again.",
+    "no_plan": "I couldn't generate a fitness plan for that. Please try rephrasing your request.",
+    "timeout": "Planning is taking longer than expected. Try a more specific question.",
+    "rate_limited": "I'm handling a lot of requests right now. Please try again in a minute.",
+    "error": "An unexpected error occurred. Please try again."
+}
+# A reply ending in one of these failed, even if part of a stream was shown before it
+FALLBACK_TEXTS = tuple(FALLBACK_REPLIES.values())
+
+# Acknowledgements that need no planning call
+TRIVIAL_MESSAGES = frozenset([
+    "thanks", "thank you", "ty", "thx", "\U0001F44D", "\U0001F64F"
+])
+TRIVIAL_REPLY = "You're welcome! Ready to continue with your plan, or is there anything you'd like to adjust?"
+
+# A repeat of the last question only counts as an accidental double-send within this window
+DUPLICATE_WINDOW_SECONDS = 10
+
 
 # ============== Query Classification ==============
 
-def classify_query(query: str, history: List[Dict]) -> Dict[str, Any]:
-    query_lower = query.lower().strip()
-    query_clean = re.sub(r'@agent1q\w+', '', query_lower).strip()
+# Phase detection patterns, checked in order (first phase with a hit wins)
+PHASE_PATTERNS = {
+    "assessment": [
+        "assess", "fitness level", "current fitness", "starting point",
+        "how fit am i", "my stats", "bmi", "body composition",
+        "evaluate", "baseline", "fitness test"
+    ],
+    "goals": [
+        "goal", "smart goal", "target", "objective", "aim",
+        "want to lose", "want to gain", "want to build",
+        "lose weight", "gain muscle", "get stronger", "get lean",
+        "bulk", "cut", "recomp", "body recomposition"
+    ],
+    "workout": [
+        "workout", "exercise", "training", "split", "routine",
+        "push pull", "upper lower", "full body", "gym plan",
+        "program", "schedule", "sets", "reps", "cardio",
+        "hiit", "strength training", "resistance"
+    ],
+    "meal": [
+        "meal", "diet", "nutrition", "food", "eat", "calories",
+        "macro", "protein", "carb", "fat", "tdee", "meal prep",
+        "supplement", "pre workout", "post workout", "hydration"
+    ],
+    "progress": [
+        "progress", "track", "measure", "check-in", "plateau",
+        "adjust", "deload", "overtraining", "milestone",
+        "not seeing results", "stuck", "update my plan"
+    ]
+}
+
+# Context analysis patterns (use conversation history, no new planning needed)
+CONTEXT_PATTERNS = frozenset([
+    "summarize", "summary", "explain", "why", "how does",
+    "what did you", "repeat", "show again", "recap",
+    "from before", "you said", "earlier"
+])
+
+# Compiled once at import so classification is a single regex call. Each phase is a named
+# group behind a lazy ".*?": match() exhausts one phase's branch over the whole query before
+# trying the next, so phase order (not position in the query) still decides which wins
+AGENT_RE = re.compile(r'@agent1q\w+\s*')
+PHASE_RE = re.compile("|".join(
+    f".*?(?P<{phase}>" + "|".join(map(re.escape, patterns)) + ")"
+    for phase, patterns in PHASE_PATTERNS.items()
+), re.S)
+CONTEXT_RE = re.compile("|".join(map(re.escape, sorted(CONTEXT_PATTERNS))))
+
+
+def sent_within(timestamp: str, received_at: datetime, seconds: float) -> bool:
+    try:
+        return (received_at - datetime.fromisoformat(timestamp)).total_seconds() <= seconds
+    except (TypeError, ValueError):
+        return False
+
+
+def classify_query(query: str, history: List[Turn], received_at: Optional[datetime] = None) -> Dict[str, Any]:
+    query_clean = query.lower()
 
     classification = {
         "type": "general",
@@ -192,59 +513,88 @@ def classify_query(query: str, history: List[Dict]) -> Dict[str, Any]:
         "needs_planning": True
     }
 
-    # Phase detection patterns
-    phase_patterns = {
-        "assessment": [
-            "assess", "fitness level", "current fitness", "starting point",
-            "how fit am i", "my stats", "bmi", "body composition",
-            "evaluate", "baseline", "fitness test"
-        ],
-        "goals": [
-            "goal", "smart goal", "target", "objective", "aim",
-            "want to lose", "want to gain", "want to build",
-            "lose weight", "gain muscle", "get stronger", "get lean",
-            "bulk", "cut", "recomp", "body recomposition"
-        ],
-        "workout": [
-            "workout", "exercise", "training", "split", "routine",
-            "push pull", "upper lower", "full body", "gym plan",
-            "program", "schedule", "sets", "reps", "cardio",
-            "hiit", "strength training", "resistance"
-        ],
-        "meal": [
-            "meal", "diet", "nutrition", "food", "eat", "calories",
-            "macro", "protein", "carb", "fat", "tdee", "meal prep",
-            "supplement", "pre workout", "post workout", "hydration"
-        ],
-        "progress": [
-            "progress", "track", "measure", "check-in", "plateau",
-            "adjust", "deload", "overtraining", "milestone",
-            "not seeing results", "stuck", "update my plan"
-        ]
-    }
-
-    for phase, patterns in phase_patterns.items():
-        for pattern in patterns:
-            if pattern in query_clean:
-                classification["phase"] = phase
-                classification["type"] = f"phase_{phase}"
-                return classification
-
-    # Context analysis patterns (use conversation history, no new planning needed)
-    context_patterns = [
-        "summarize", "summary", "explain", "why", "how does",
-        "what did you", "repeat", "show again", "recap",
-        "from before", "you said", "earlier"
-    ]
-    for pattern in context_patterns:
-        if pattern in query_clean:
-            classification["type"] = "context_analysis"
-            classification["needs_planning"] = False
-            return classification
+    # Direct replies: thank-yous, or the question just answered sent again by accident
+    if query_clean.strip(".! ") in TRIVIAL_MESSAGES:
+        classification["type"] = "direct"
+        classification["needs_planning"] = False
+        classification["reply"] = TRIVIAL_REPLY
+        return classification
+    if (
+        received_at is not None
+        and len(history) >= 2
+        and history[-2].role == "user"
+        and history[-2].content == query[:MAX_STORED_CHARS]
+        and history[-1].role == "assistant"
+        and not history[-1].content.endswith(FALLBACK_TEXTS)
+        and sent_within(history[-2].timestamp, received_at, DUPLICATE_WINDOW_SECONDS)
+    ):
+        classification["type"] = "direct"
+        classification["needs_planning"] = False
+        classification["reply"] = history[-1].content
+        return classification
+
+    phase_match = PHASE_RE.match(query_clean)
+    if phase_match:
+        phase = phase_match.lastgroup
+        classification["phase"] = phase
+        classification["type"] = f"phase_{phase}"
+    elif CONTEXT_RE.search(query_clean):
+        classification["type"] = "context_analysis"
+        classification["needs_planning"] = False
 
     return classification
 
 
+# ============== Rolling Conversation Summary ==============
+
+ROLLING_SUMMARY_PROMPT = """You maintain a running summary of a fitness planning conversation.
+
+Merge the previous summary with the new messages into one summary of at most 200 tokens.
+Keep concrete facts: the user's stats, limitations, equipment, goals, and any plans or numbers already agreed.
+Do not add advice or anything that was not said in the conversation."""
+ROLLING_SUMMARY_MESSAGE = {"role": "system", "content": ROLLING_SUMMARY_PROMPT}
+
+
+async def update_rolling_summary(session_data: Dict[str, Any]) -> None:
+    recent = get_recent_history(session_data)
+    if len(recent) <= SUMMARY_TRIGGER:
+        return
+
+    state = session_data["state"]
+    older = recent[:-RECENT_MESSAGES]
+    previous = state.get("rolling_summary") or "None yet."
+    # Messages go in whole (already capped at MAX_STORED_CHARS): plans and numbers must survive
+    # into the summary once they leave the verbatim window
+    new_messages = build_context_summary(older, len(older), MAX_STORED_CHARS)
+    # Taken before the call: the next message may append to history while it is in flight
+    summarized_up_to = session_data.get("history_offset", 0) + len(session_data["history"]) - RECENT_MESSAGES
+    try:
+        response = await create_chat_completion(
+            messages=[
+                ROLLING_SUMMARY_MESSAGE,
+                {
+                    "role": "user",
+                    "content": f"Previous summary:\n{previous}\n\nNew messages:\n{new_messages}"
+                }
+            ],
+            temperature=0.2,
+            max_tokens=300,
+            stream=False,
+            extra_body={"planner_mode": True}
+        )
+        if response.choices and response.choices[0].message.content:
+            state["rolling_summary"] = response.choices[0].message.content
+            state["summarized_up_to"] = summarized_up_to
+    except Exception:
+        # Keep the previous summary; the older messages stay verbatim and are retried next turn
+        pass
+
+
+def build_summary_message(state: Dict[str, Any]) -> List[Dict]:
+    summary = state.get("rolling_summary")
+    return [{"role": "system", "content": f"Prior context: {summary}"}] if summary else []
+
+
 # ============== Context Analysis (No Planning Needed) ==============
 
 CONTEXT_ANALYSIS_PROMPT = """You are a helpful fitness planning assistant reviewing conversation history.
@@ -252,126 +602,161 @@ CONTEXT_ANALYSIS_PROMPT = """You are a helpful fitness planning assistant review
 Answer the user's question based ONLY on information already discussed in the conversation.
 Do NOT create new plans or recommendations — just reference what was already provided.
 Be specific and reference actual details from previous messages."""
+CONTEXT_ANALYSIS_MESSAGE = {"role": "system", "content": CONTEXT_ANALYSIS_PROMPT}
 
 
-async def analyze_context(query: str, history: List[Dict]) -> str:
-    messages = [{"role": "system", "content": CONTEXT_ANALYSIS_PROMPT}]
-    for msg in history:
-        messages.append({"role": msg["role"], "content": msg["content"]})
+async def analyze_context(query: str, history: List[Turn], state: Dict[str, Any], on_chunk: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
+    messages = [CONTEXT_ANALYSIS_MESSAGE, *build_summary_message(state), *build_history_messages(history)]
 
-    clean_query = re.sub(r'@agent1q\w+\s*', '', query).strip()
     messages.append({
         "role": "user",
-        "content": f"Based on our conversation so far, please answer: {clean_query}"
+        "content": f"Based on our conversation so far, please answer: {query}"
     })
 
     try:
-        response = client.chat.completions.create(
-            model="asi1",
+        result = await stream_chat_completion(
+            on_chunk,
             messages=messages,
             temperature=0.3,
             top_p=0.9,
             max_tokens=3000,
-            stream=False,
             extra_body={"planner_mode": True}
         )
-        if response.choices and len(response.choices) > 0:
-            return response.choices[0].message.content
-        return "I couldn't find the information in our conversation. Could you rephrase?"
+        return result or FALLBACK_REPLIES["no_context_answer"]
+    except openai.RateLimitError:
+        return FALLBACK_REPLIES["rate_limited"]
+    except Exception:
+        return FALLBACK_REPLIES["context_error"]
+
+
+# ============== Response Cache ==============
+
+pending_cache_writes = set()
+
+
+async def cache_response(cache_key: str, result: str) -> None:
+    try:
+        await redis_client.set(cache_key, result, ex=RESPONSE_CACHE_TTL_SECONDS)
     except Exception:
-        return "An error occurred while reviewing our conversation. Please try again."
+        # A failed write only costs a cache miss next time
+        pass
+
+
+def schedule_cache_write(cache_key: str, result: str) -> None:
+    # Like session saves, the write runs off the reply path
+    task = asyncio.create_task(cache_response(cache_key, result))
+    pending_cache_writes.add(task)
+    task.add_done_callback(pending_cache_writes.discard)
 
 
 # ============== Fitness Planning Function (Planner Mode) ==============
 
-async def plan_fitness_response(query: str, history: List[Dict], state: Dict[str, Any]) -> str:
-    classification = classify_query(query, history)
+async def plan_fitness_response(query: str, history: List[Turn], state: Dict[str, Any], on_chunk: Optional[Callable[[str], Awaitable[None]]] = None, received_at: Optional[datetime] = None) -> str:
+    classification = classify_query(query, history, received_at)
+
+    # Thank-yous and accidental double-sends are answered without calling ASI1
+    if classification["type"] == "direct":
+        return classification["reply"]
 
     # If it's a context query, just analyze history
     if classification["type"] == "context_analysis":
-        return await analyze_context(query, history)
+        return await analyze_context(query, history, state, on_chunk)
 
-    # Build messages with system prompt and history
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    # Build messages with system prompt, summary of older turns, and recent history
+    messages = [SYSTEM_MESSAGE, *build_summary_message(state)]
 
     # Add conversation history for continuity
-    for msg in history[-16:]:
-        messages.append({
-            "role": msg["role"],
-            "content": msg["content"][:1500]
-        })
-
-    # Clean query
-    clean_query = re.sub(r'@agent1q\w+\s*', '', query).strip()
+    messages.extend(build_history_messages(history))
 
     # Build phase-aware query
     phase = classification.get("phase")
     if phase:
-        phase_context = build_phase_query(clean_query, phase, state)
+        phase_context = build_phase_query(query, phase, state)
     else:
-        phase_context = build_general_query(clean_query, state)
+        phase_context = build_general_query(query, state)
 
     messages.append({"role": "user", "content": phase_context})
 
+    # Opening questions repeat across users; follow-ups depend on session history so are never cached
+    cache_key = None
+    if redis_client is not None and not classification["is_followup"]:
+        cache_key = "llm:" + hashlib.blake2b(orjson.dumps(messages), digest_size=16).hexdigest()
+
+    if cache_key:
+        try:
+            cached = await redis_client.get(cache_key)
+        except Exception:
+            # Cache unavailable: fall through to a normal call
+            cached = None
+        if cached:
+            if phase:
+                state["current_phase"] = phase
+            return cached.decode()
+
     try:
-        response = client.chat.completions.create(
-            model="asi1",
+        result = await stream_chat_completion(
+            on_chunk,
             messages=messages,
             temperature=0.4,
             top_p=0.9,
             max_tokens=2000,
             presence_penalty=0.1,
             frequency_penalty=0.1,
-            stream=False,
             extra_body={"planner_mode": True, "web_search": False}
         )
-        if response.choices and len(response.choices) > 0:
-            result = response.choices[0].message.content
+        if result:
+            if cache_key:
+                schedule_cache_write(cache_key, result)
 
             # Update state phase tracking
             if phase:
                 state["current_phase"] = phase
 
             return result
-        return "I couldn't generate a fitness plan for that. Please try rephrasing your request."
+        return FALLBACK_REPLIES["no_plan"]
     except asyncio.TimeoutError:
-        return "Planning is taking longer than expected. Try a more specific question."
+        return FALLBACK_REPLIES["timeout"]
+    except openai.RateLimitError:
+        return FALLBACK_REPLIES["rate_limited"]
     except Exception:
-        return "An unexpected error occurred. Please try again."
+        return FALLBACK_REPLIES["error"]
 
 
-def build_phase_query(query: str, phase: str, state: Dict[str, Any]) -> str:
-    current_phase = state.get("current_phase", "intake")
-    profile = state.get("fitness_profile", {})
-
-    profile_summary = ""
-    if profile:
-        profile_summary = f"\n**Known User Profile:** {profile}"
-
-    phase_instructions = {
-        "assessment": f"""The user wants to work on their FITNESS ASSESSMENT (Phase 1).
+# Per-phase instructions, filled with the user's profile summary for the selected phase only
+PHASE_INSTRUCTION_TEMPLATES = {
+    "assessment": """The user wants to work on their FITNESS ASSESSMENT (Phase 1).
 {profile_summary}
 Ask targeted questions to build their fitness profile. Gather: age, gender, height, weight, activity level, exercise history, injuries/limitations, available equipment, and time availability.
 If some info is already known, skip those questions.""",
 
-        "goals": f"""The user wants to SET FITNESS GOALS (Phase 2).
+    "goals": """The user wants to SET FITNESS GOALS (Phase 2).
 {profile_summary}
 Help them define SMART goals. Use their assessment data to make goals realistic. Suggest specific, measurable targets with timeframes.""",
 
-        "workout": f"""The user wants a WORKOUT PLAN (Phase 3).
+    "workout": """The user wants a WORKOUT PLAN (Phase 3).
 {profile_summary}
 Design a weekly training split appropriate for their level and goals. Include exercises, sets, reps, rest periods, and progressive overload strategy.""",
 
-        "meal": f"""The user wants a MEAL PLAN (Phase 4).
+    "meal": """The user wants a MEAL PLAN (Phase 4).
 {profile_summary}
 Create a nutrition framework. Estimate TDEE, suggest macro splits, provide sample meal templates, and cover pre/post workout nutrition.""",
 
-        "progress": f"""The user wants PROGRESS TRACKING guidance (Phase 5).
+    "progress": """The user wants PROGRESS TRACKING guidance (Phase 5).
 {profile_summary}
 Set up their monitoring system: weekly metrics, workout logging, plateau identification, and plan adjustment criteria."""
-    }
+}
+
+
+def build_phase_query(query: str, phase: str, state: Dict[str, Any]) -> str:
+    current_phase = state.get("current_phase", "intake")
+    profile = state.get("fitness_profile", {})
 
-    instruction = phase_instructions.get(phase, "Respond helpfully to the user's fitness question.")
+    profile_summary = ""
+    if profile:
+        profile_summary = f"\n**Known User Profile:** {profile}"
+
+    template = PHASE_INSTRUCTION_TEMPLATES.get(phase)
+    instruction = template.format(profile_summary=profile_summary) if template else "Respond helpfully to the user's fitness question."
 
     return f"""**User Request:** {query}
 
@@ -397,39 +782,64 @@ If they have an existing profile, continue from where they left off.
 Use planning and reasoning only — no web search."""
 
 
-# ============== Chat Handlers ==============
+# ============== Batch Planning (Offline, Non-Interactive) ==============
 
-@chat_proto.on_message(ChatMessage)
-async def handle_message(ctx: Context, sender: str, msg: ChatMessage):
-    try:
-        ctx.logger.info(f"Received message from {sender}")
-
-        await ctx.send(
-            sender,
-            ChatAcknowledgement(
-                timestamp=datetime.now(timezone.utc),
-                acknowledged_msg_id=msg.msg_id,
-            ),
-        )
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
-        session_id = str(ctx.session) if hasattr(ctx, "session") and ctx.session else f"{sender}_{int(datetime.now(timezone.utc).timestamp())}"
-        ctx.logger.info(f"Session ID: {session_id}")
 
-        session_data = get_session_data(ctx, sender, session_id)
-        history = session_data["history"]
-        state = session_data["state"]
+async def submit_batch(queries: List[str], poll_interval: float = 60.0) -> List[str]:
+    # For bulk re-planning only: the Batch API trades latency (up to 24h) for cost
+    lines = []
+    for i, query in enumerate(queries):
+        lines.append(orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "asi1",
+                "messages": [
+                    SYSTEM_MESSAGE,
+                    {"role": "user", "content": build_general_query(query, {})}
+                ],
+                "temperature": 0.4,
+                "top_p": 0.9,
+                "max_tokens": 2000,
+                "presence_penalty": 0.1,
+                "frequency_penalty": 0.1,
+                # Same planner mode as live replies; these go in the request body directly
+                "planner_mode": True,
+                "web_search": False
+            }
+        }))
+
+    batch_file = await client.files.create(file=("fitness_batch.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
 
-        text = extract_text(msg)
+    # A failed or expired batch must not look like a batch of empty answers
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
 
-        if not text:
-            for item in msg.content:
-                if isinstance(item, StartSessionContent):
-                    ctx.logger.info(f"Session started with {sender}")
-                    state["greeted"] = True
-                    session_data["state"] = state
-                    save_session_data(ctx, sender, session_id, session_data)
+    results = [""] * len(queries)
+
+    output = await client.files.content(batch.output_file_id)
+    for line in output.text.splitlines():
+        item = orjson.loads(line)
+        body = (item.get("response") or {}).get("body") or {}
+        if body.get("choices"):
+            results[int(item["custom_id"])] = body["choices"][0]["message"]["content"]
+    return results
+
+
+# ============== Chat Handlers ==============
 
-                    welcome_message = """Welcome to the Fitness Goal Planner Agent!
+WELCOME_MESSAGE = """Welcome to the Fitness Goal Planner Agent!
 
 I'll guide you through a complete fitness planning journey using a structured 5-phase approach:
 
@@ -447,69 +857,136 @@ You can:
 
 Let's begin! Tell me about yourself — what's your current fitness level, and what are you hoping to achieve?"""
 
-                    await ctx.send(sender, create_text_chat(welcome_message))
-                    return
+GOODBYE_MESSAGE = (
+    "Great session! Your fitness plan has been saved.\n"
+    "Come back anytime to adjust your plan or track progress.\n"
+    "Stay consistent and trust the process!"
+)
+
+
+async def send_with_retry(ctx: Context, sender: str, message: ChatMessage, max_retries: int = 3) -> None:
+    for attempt in range(max_retries):
+        try:
+            await ctx.send(sender, message)
+            return
+        except Exception as send_err:
+            ctx.logger.warning("Send attempt %d/%d failed: %s", attempt + 1, max_retries, send_err)
+            if attempt < max_retries - 1:
+                await asyncio.sleep(2 * (attempt + 1))
+            else:
+                ctx.logger.error("All %d send attempts failed for %s", max_retries, sender)
+                raise
+
+
+@chat_proto.on_message(ChatMessage)
+async def handle_message(ctx: Context, sender: str, msg: ChatMessage):
+    # One clock read per message, shared by the ack, history entries, session save and session replies
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
+    ack = None
+    try:
+        ctx.logger.info("Received message from %s", sender)
+
+        session_id = str(ctx.session) if hasattr(ctx, "session") and ctx.session else f"{sender}_{int(now.timestamp())}"
+        ctx.logger.debug("Session ID: %s", session_id)
+
+        # Acknowledge right away; handling itself is serialized per session so overlapping
+        # messages from the same user see each other's turns
+        ack = asyncio.create_task(
+            ctx.send(
+                sender,
+                ChatAcknowledgement(
+                    timestamp=now,
+                    acknowledged_msg_id=msg.msg_id,
+                ),
+            )
+        )
+        text, start_session, end_session = extract_content(msg)
+
+        async with get_session_lock(get_session_key(sender, session_id)):
+            session_data = await get_session_data(ctx, sender, session_id, now_iso)
+            await ack
+            history = session_data["history"]
+            state = session_data["state"]
 
-                elif isinstance(item, EndSessionContent):
-                    ctx.logger.info(f"Session ended with {sender}")
-                    save_session_data(ctx, sender, session_id, session_data)
+            if not text:
+                if start_session:
+                    ctx.logger.info("Session started with %s", sender)
+                    state["greeted"] = True
+                    schedule_save(ctx, sender, session_id, session_data, timestamp=now_iso)
+                    await ctx.send(sender, create_text_chat(WELCOME_MESSAGE, timestamp=now))
+
+                elif end_session:
+                    ctx.logger.info("Session ended with %s", sender)
+                    schedule_save(ctx, sender, session_id, session_data, timestamp=now_iso)
                     await ctx.send(
                         sender,
-                        create_text_chat(
-                            "Great session! Your fitness plan has been saved.\n"
-                            "Come back anytime to adjust your plan or track progress.\n"
-                            "Stay consistent and trust the process!",
-                            end_session=True
-                        )
+                        create_text_chat(GOODBYE_MESSAGE, end_session=True, timestamp=now)
                     )
-                    return
-            return
+                return
+
+            # Agent mentions are stripped once here; everything downstream gets the clean text
+            clean_text = AGENT_RE.sub('', text).strip()
+            # Verbose per-turn details (and the extra classification they need) only at DEBUG
+            debug = ctx.logger.isEnabledFor(logging.DEBUG)
 
-        ctx.logger.info(f"Query: {text[:100]}")
+            add_to_history(history, "user", clean_text, now_iso)
+            recent_history = get_recent_history(session_data)[:-1]
 
-        history = add_to_history(history, "user", text)
+            if debug:
+                classification = classify_query(clean_text, recent_history, now)
+                ctx.logger.debug("Query: %s", clean_text[:100])
+                ctx.logger.debug("Query classification: %s, phase: %s", classification["type"], classification["phase"])
 
-        classification = classify_query(text, history[:-1])
-        ctx.logger.info(f"Query classification: {classification['type']}, phase: {classification.get('phase')}")
+            # Long replies are streamed to the sender piece by piece as they are generated,
+            # between start-stream and end-stream markers sharing one stream id
+            stream_id = uuid4()
+            shown = []
 
-        result = await plan_fitness_response(text, history[:-1], state)
+            async def send_chunk(chunk: str) -> None:
+                await send_with_retry(ctx, sender, create_stream_chat(stream_id, chunk, start=not shown))
+                shown.append(chunk)
 
-        ctx.logger.info(f"Result: {result[:200]}")
+            result = await plan_fitness_response(clean_text, recent_history, state, send_chunk, now)
 
-        history = add_to_history(history, "assistant", result)
+            if debug:
+                ctx.logger.debug("Result: %s", result[:200])
 
-        session_data["history"] = history
-        session_data["state"] = state
-        save_session_data(ctx, sender, session_id, session_data)
+            # A stream that broke off is followed by a fallback; history keeps what the user saw of both
+            broke_off = bool(shown) and result in FALLBACK_REPLIES.values()
+            add_to_history(history, "assistant", f"{''.join(shown)}\n\n{result}" if broke_off else result, now_iso)
 
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                await ctx.send(sender, create_text_chat(result))
-                ctx.logger.info(f"Sent response to {sender}")
-                break
-            except Exception as send_err:
-                ctx.logger.warning(f"Send attempt {attempt + 1}/{max_retries} failed: {send_err}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 * (attempt + 1))
-                else:
-                    ctx.logger.error(f"All {max_retries} send attempts failed for {sender}")
-                    raise
+            schedule_save(ctx, sender, session_id, session_data, summarize=True, timestamp=now_iso)
+
+            if shown:
+                # Closed even when the stream broke off, so the client knows no more chunks follow
+                await send_with_retry(ctx, sender, create_stream_chat(stream_id))
+                if not broke_off:
+                    ctx.logger.info("Streamed response to %s", sender)
+                    return
+
+            # Not streamed (cached, direct or fallback reply): send it in one message, stamped
+            # when sent so it sorts after any stream it follows
+            await send_with_retry(ctx, sender, create_text_chat(result))
+            ctx.logger.info("Sent response to %s", sender)
 
     except Exception as e:
-        ctx.logger.error(f"Error in handle_message: {e}")
-        ctx.logger.error(f"Traceback: {traceback.format_exc()}")
+        ctx.logger.error("Error in handle_message: %s", e)
+        ctx.logger.error("Traceback: %s", traceback.format_exc())
+        if ack is not None:
+            # Loading may fail before the ack is awaited; collect its outcome so it isn't lost
+            ack_result, = await asyncio.gather(ack, return_exceptions=True)
+            if isinstance(ack_result, Exception) and ack_result is not e:
+                ctx.logger.error("Failed to send acknowledgement: %s", ack_result)
         try:
             await ctx.send(
                 sender,
                 create_text_chat("Sorry, I encountered a technical issue. Please try again.")
             )
         except Exception as send_error:
-            ctx.logger.error(f"Failed to send error message: {send_error}")
+            ctx.logger.error("Failed to send error message: %s", send_error)
 
 
 @chat_proto.on_message(ChatAcknowledgement)
 async def handle_acknowledgement(ctx: Context, sender: str, msg: ChatAcknowledgement):
-    ctx.logger.info(
-        f"Received acknowledgement from {sender} for message {msg.acknowledged_msg_id}"
-    )
+    ctx.logger.debug("Received acknowledgement from %s for message %s", sender, msg.acknowledged_msg_id)